@@ -1,8 +1,29 @@
+import asyncio
 import discord
-import datetime
+import logging
+from datetime import datetime, timedelta, timezone
+import time
 from collections import defaultdict
 from redbot.core import commands, Config
 
+log = logging.getLogger("red.antiraid")
+
+# Discord snowflakes count milliseconds from this Unix time
+DISCORD_EPOCH_MS = 1420070400000
+
+# Seconds during which repeat triggers for an already punished user are ignored
+PUNISH_COOLDOWN = 30
+
+# Past tense of each punishment action, used in alerts and logs
+ACTION_VERBS = {"mute": "Muted", "kick": "Kicked", "ban": "Banned"}
+
+# Shared by every alert so the ping role can notify
+_ALLOWED_MENTIONS_ROLES = discord.AllowedMentions(roles=True)
+
+# Skeleton for the action log. It must stay field-free: Embed.copy() shares the
+# field dicts, so fields are only ever added to the copy.
+_LOG_EMBED_TEMPLATE = discord.Embed(title="🛡️ AntiRaid Action Log", color=discord.Color.red())
+
 class AntiRaid(commands.Cog):
     """
     Monitors chat for spam velocity and mass mentions to prevent raids.
@@ -27,114 +48,243 @@ class AntiRaid(commands.Cog):
         }
         self.config.register_guild(**default_guild)
         
-        self.message_history = defaultdict(lambda: defaultdict(list))
+        # Guild ID -> {user ID -> (window start, messages in window)}
+        self.message_history = defaultdict(dict)
+        # Guild ID -> settings dict, dropped whenever a setting changes
+        self._settings_cache = {}
+        # Guild ID -> count of setting changes, so a fill that raced a change is dropped
+        self._settings_gen = defaultdict(int)
+        self._sweeper = None
+        # (guild ID, user ID) pairs punished within the last PUNISH_COOLDOWN seconds
+        self._recently_punished = set()
+        # Guild ID -> {member ID -> has administrator}, dropped when roles change
+        self._admin_cache = defaultdict(dict)
+        # Guild ID -> position of the bot's top role, dropped when roles change
+        self._bot_top_role_pos = {}
+
+    async def cog_load(self):
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def cog_unload(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+
+    async def _sweep_loop(self):
+        """Periodically evicts users whose message history has gone stale."""
+        while True:
+            await asyncio.sleep(60)
+            self._sweep_history()
+
+    def _sweep_history(self):
+        now = time.time()
+        for guild_id in list(self.message_history):
+            guild_history = self.message_history[guild_id]
+            settings = self._settings_cache.get(guild_id)
+            if settings is None:
+                # Settings were just changed; wait for the next message to reload them
+                continue
+            cutoff = now - settings["spam_interval"]
+            for user_id in [u for u, (start, _) in guild_history.items() if start < cutoff]:
+                del guild_history[user_id]
+            if not guild_history:
+                del self.message_history[guild_id]
+
+    async def _get_settings(self, guild: discord.Guild) -> dict:
+        """Returns the guild's settings, reading Config only on a cache miss."""
+        settings = self._settings_cache.get(guild.id)
+        if settings is None:
+            gen = self._settings_gen[guild.id]
+            settings = await self.config.guild(guild).all()
+            settings["whitelist_roles"] = frozenset(settings["whitelist_roles"])
+            # A setter ran while we were reading; what we read may be stale
+            if self._settings_gen[guild.id] == gen:
+                self._settings_cache[guild.id] = settings
+        return settings
+
+    def _invalidate_settings(self, guild: discord.Guild):
+        """Drops the guild's cached settings after a setting changes."""
+        self._settings_gen[guild.id] += 1
+        self._settings_cache.pop(guild.id, None)
 
     async def _punish_user(self, message: discord.Message, reason: str):
         """Executes the configured punishment, logs it, and pings mods."""
         guild = message.guild
         member = message.author
-        settings = await self.config.guild(guild).all()
+
+        settings = await self._get_settings(guild)
         action = settings["action"]
 
-        if member.top_role >= guild.me.top_role:
-            return 
+        bot_pos = self._bot_top_role_pos.get(guild.id)
+        if bot_pos is None:
+            bot_pos = self._bot_top_role_pos[guild.id] = guild.me.top_role.position
+        if member.top_role.position >= bot_pos:
+            return
+
+        # Burst spam triggers this once per message; only the first call should act.
+        # Checking and marking without an await in between makes this race-free.
+        # The mark is dropped again if the punishment doesn't go through.
+        key = (guild.id, member.id)
+        if key in self._recently_punished:
+            return
+        self._recently_punished.add(key)
 
         # --- 1. Execute Punishment ---
         try:
-            # Delete spammy messages
-            def check(m):
-                return m.author == member and (message.created_at - m.created_at).total_seconds() < 10
-            
-            await message.channel.purge(limit=15, check=check)
+            # Delete spammy messages from the last 10 seconds
+            cutoff_ts = message.created_at.timestamp() - 10
+            check = lambda m, mid=member.id, c=cutoff_ts: m.author.id == mid and m.created_at.timestamp() > c
 
             if action == "mute":
-                duration = datetime.timedelta(seconds=settings["mute_duration"])
-                await member.timeout(duration, reason=reason)
-                action_verbed = "Muted"
+                duration = timedelta(seconds=settings["mute_duration"])
+                punishment = member.timeout(duration, reason=reason)
             
             elif action == "kick":
-                await member.kick(reason=reason)
-                action_verbed = "Kicked"
+                punishment = member.kick(reason=reason)
             
             elif action == "ban":
-                await member.ban(reason=reason, delete_message_days=1)
-                action_verbed = "Banned"
+                punishment = member.ban(reason=reason, delete_message_days=1)
+
+            # The purge and the punishment are independent, so run them together.
+            # A failed purge shouldn't stop the alert; a failed punishment should.
+            purged, result = await asyncio.gather(
+                message.channel.purge(limit=15, check=check),
+                punishment,
+                return_exceptions=True,
+            )
+            if isinstance(purged, BaseException):
+                log.warning("Failed to purge messages from %s in %s", member.id, guild.name, exc_info=purged)
+            if isinstance(result, BaseException):
+                raise result
 
         except discord.Forbidden:
-            print(f"[AntiRaid] Missing permissions to punish {member.id} in {guild.name}.")
+            self._recently_punished.discard(key)
+            log.warning("Missing permissions to punish %s in %s.", member.id, guild.name)
             return
-        except Exception as e:
-            print(f"[AntiRaid] Error: {e}")
+        except Exception:
+            self._recently_punished.discard(key)
+            log.exception("Failed to punish %s in %s.", member.id, guild.name)
             return
+        except BaseException:
+            # Cancelled mid-punishment; let the next trigger retry
+            self._recently_punished.discard(key)
+            raise
 
-        # --- 2. Send Alert/Ping in Chat ---
-        alert_content = f"🛡️ **AntiRaid:** {action_verbed} {member.mention} for spamming/raiding."
-        
-        if settings["ping_role"]:
-            role = guild.get_role(settings["ping_role"])
-            if role:
-                # Add the ping and custom message
-                alert_content = f"{role.mention} {settings['ping_message']}\n" + alert_content
-        
-        try:
-            await message.channel.send(alert_content, allowed_mentions=discord.AllowedMentions(roles=True))
-        except:
-            pass
+        asyncio.get_running_loop().call_later(PUNISH_COOLDOWN, self._recently_punished.discard, key)
 
-        # --- 3. Send Detailed Log ---
+        # --- 2. Build Alert/Ping for Chat ---
+        action_verbed = ACTION_VERBS[action]
+        role = guild.get_role(settings["ping_role"]) if settings["ping_role"] else None
+        # Prefix the ping and custom message when a ping role is set
+        ping = f"{role.mention} {settings['ping_message']}\n" if role else ""
+        alert_content = f"{ping}🛡️ **AntiRaid:** {action_verbed} {member.mention} for spamming/raiding."
+
+        sends = [message.channel.send(alert_content, allowed_mentions=_ALLOWED_MENTIONS_ROLES)]
+
+        # --- 3. Build Detailed Log ---
+        log_chan = None
         if settings["log_channel"]:
             log_chan = guild.get_channel(settings["log_channel"])
             if log_chan:
-                embed = discord.Embed(title="🛡️ AntiRaid Action Log", color=discord.Color.red(), timestamp=datetime.datetime.utcnow())
+                embed = _LOG_EMBED_TEMPLATE.copy()
+                embed.timestamp = datetime.now(timezone.utc)
                 embed.add_field(name="User", value=f"{member.name} ({member.id})", inline=True)
                 embed.add_field(name="Action", value=action_verbed, inline=True)
                 embed.add_field(name="Reason", value=reason, inline=False)
                 embed.add_field(name="Channel", value=message.channel.mention, inline=True)
                 embed.set_thumbnail(url=member.display_avatar.url)
-                
-                try:
-                    await log_chan.send(embed=embed)
-                except:
-                    print(f"[AntiRaid] Failed to send log to channel {settings['log_channel']}")
+                sends.append(log_chan.send(embed=embed))
+
+        # --- 4. Send Both Concurrently ---
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        if log_chan and isinstance(results[1], BaseException):
+            log.warning("Failed to send log to channel %s", settings["log_channel"], exc_info=results[1])
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        if not message.guild or message.author.bot:
+        guild = message.guild
+        author = message.author
+        if not guild or author.bot:
             return
 
-        settings = await self.config.guild(message.guild).all()
+        # Cache hit keeps the common (disabled) path free of any await
+        settings = self._settings_cache.get(guild.id)
+        if settings is None:
+            settings = await self._get_settings(guild)
         if not settings["enabled"]:
             return
 
-        user_roles = [r.id for r in message.author.roles]
-        if any(rid in settings["whitelist_roles"] for rid in user_roles):
+        guild_admins = self._admin_cache[guild.id]
+        is_admin = guild_admins.get(author.id)
+        if is_admin is None:
+            is_admin = guild_admins[author.id] = author.guild_permissions.administrator
+        if is_admin:
             return
-        if message.author.guild_permissions.administrator:
+
+        whitelist = settings["whitelist_roles"]
+        if whitelist and not whitelist.isdisjoint(r.id for r in author.roles):
             return
 
         # --- CHECK 1: Mass Mentions ---
-        mention_count = len(message.mentions) + len(message.role_mentions)
-        if message.mention_everyone:
-            mention_count += 1
-        
-        if mention_count >= settings["mention_limit"]:
-            await self._punish_user(message, f"AntiRaid: Exceeded mention limit ({mention_count})")
-            return
+        # Most messages mention no one, so skip counting entirely for those
+        if message.mentions or message.role_mentions or message.mention_everyone:
+            mention_count = len(message.mentions) + len(message.role_mentions)
+            if message.mention_everyone:
+                mention_count += 1
+
+            if mention_count >= settings["mention_limit"]:
+                await self._punish_user(message, f"AntiRaid: Exceeded mention limit ({mention_count})")
+                return
 
         # --- CHECK 2: Message Velocity ---
-        now = message.created_at.timestamp()
-        user_history = self.message_history[message.guild.id][message.author.id]
-        
-        user_history.append(now)
-        
-        cutoff = now - settings["spam_interval"]
-        self.message_history[message.guild.id][message.author.id] = [
-            t for t in user_history if t > cutoff
-        ]
-        
-        if len(self.message_history[message.guild.id][message.author.id]) >= settings["spam_limit"]:
-            self.message_history[message.guild.id][message.author.id] = []
+        # When the user sent it, not when we got it: a gateway resume replays a
+        # backlog at once. Decoding the snowflake skips the datetime conversion.
+        now = ((message.id >> 22) + DISCORD_EPOCH_MS) / 1000
+
+        # Fixed window per user: count messages since the window opened and
+        # start a new window once spam_interval has passed
+        guild_history = self.message_history[guild.id]
+        start, count = guild_history.get(author.id, (now, 0))
+        if now - start > settings["spam_interval"]:
+            start, count = now, 0
+        count += 1
+
+        if count >= settings["spam_limit"]:
+            guild_history.pop(author.id, None)
             await self._punish_user(message, "AntiRaid: Exceeded message velocity limit")
+        else:
+            guild_history[author.id] = (start, count)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        # A kicked raider who rejoins must not ride out the rest of the cooldown
+        self._recently_punished.discard((member.guild.id, member.id))
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        self._admin_cache.get(after.guild.id, {}).pop(after.id, None)
+        if after.id == self.bot.user.id:
+            self._bot_top_role_pos.pop(after.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self._admin_cache.get(member.guild.id, {}).pop(member.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        # The owner is implicitly an admin, and ownership transfers fire no member update
+        if before.owner_id != after.owner_id:
+            self._admin_cache.pop(after.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        # A role's permissions or position may have changed; recompute for everyone
+        self._admin_cache.pop(after.guild.id, None)
+        self._bot_top_role_pos.pop(after.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self._admin_cache.pop(role.guild.id, None)
+        self._bot_top_role_pos.pop(role.guild.id, None)
 
     # --- Configuration Commands ---
 
@@ -150,6 +300,7 @@ class AntiRaid(commands.Cog):
         """Enable or disable AntiRaid."""
         current = await self.config.guild(ctx.guild).enabled()
         await self.config.guild(ctx.guild).enabled.set(not current)
+        self._invalidate_settings(ctx.guild)
         status = "Enabled" if not current else "Disabled"
         await ctx.send(f"AntiRaid is now **{status}**.")
 
@@ -159,6 +310,7 @@ class AntiRaid(commands.Cog):
         if action.lower() not in ["mute", "kick", "ban"]:
             return await ctx.send("Action must be one of: `mute`, `kick`, `ban`.")
         await self.config.guild(ctx.guild).action.set(action.lower())
+        self._invalidate_settings(ctx.guild)
         await ctx.send(f"Punishment action set to: **{action.lower()}**.")
 
     @antiraid.command(name="spamlimit")
@@ -166,12 +318,14 @@ class AntiRaid(commands.Cog):
         """Set spam threshold (e.g. 7 messages in 5 seconds)."""
         await self.config.guild(ctx.guild).spam_limit.set(messages)
         await self.config.guild(ctx.guild).spam_interval.set(seconds)
+        self._invalidate_settings(ctx.guild)
         await ctx.send(f"Limit set: **{messages} messages** within **{seconds} seconds**.")
 
     @antiraid.command(name="mentionlimit")
     async def ar_mentionlimit(self, ctx: commands.Context, limit: int):
         """Set max mentions per message."""
         await self.config.guild(ctx.guild).mention_limit.set(limit)
+        self._invalidate_settings(ctx.guild)
         await ctx.send(f"Mention limit set to **{limit}** per message.")
 
     @antiraid.group(name="whitelist")
@@ -187,6 +341,7 @@ class AntiRaid(commands.Cog):
                 await ctx.send(f"Added {role.name} to whitelist.")
             else:
                 await ctx.send("That role is already whitelisted.")
+        self._invalidate_settings(ctx.guild)
 
     @ar_whitelist.command(name="remove")
     async def wl_remove(self, ctx: commands.Context, role: discord.Role):
@@ -196,6 +351,7 @@ class AntiRaid(commands.Cog):
                 await ctx.send(f"Removed {role.name} from whitelist.")
             else:
                 await ctx.send("That role is not whitelisted.")
+        self._invalidate_settings(ctx.guild)
 
     # --- New Commands ---
 
@@ -208,6 +364,7 @@ class AntiRaid(commands.Cog):
         else:
             await self.config.guild(ctx.guild).log_channel.set(None)
             await ctx.send("Logging disabled.")
+        self._invalidate_settings(ctx.guild)
 
     @antiraid.command(name="pingrole")
     async def ar_pingrole(self, ctx: commands.Context, role: discord.Role = None):
@@ -218,11 +375,13 @@ class AntiRaid(commands.Cog):
         else:
             await self.config.guild(ctx.guild).ping_role.set(None)
             await ctx.send("Role pings disabled.")
+        self._invalidate_settings(ctx.guild)
 
     @antiraid.command(name="pingmessage")
     async def ar_pingmessage(self, ctx: commands.Context, *, message: str):
         """Set the custom text to send with the role ping."""
         await self.config.guild(ctx.guild).ping_message.set(message)
+        self._invalidate_settings(ctx.guild)
         await ctx.send(f"Ping message set to: `{message}`")
 
     @antiraid.command(name="view")